@@ -1,10 +1,13 @@
-import os, zipfile, io, shutil, re
-import pandas as pd
+import os, zipfile, io, shutil, re, csv, threading, hashlib, uuid, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import click
 from flask import Flask, render_template, request, redirect, url_for, send_file, jsonify, flash
 import mimetypes
-from aip import AipOcr
-from pdf2image import convert_from_path
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from werkzeug.exceptions import ClientDisconnected
 from config import BAIDU_CONFIG, POPPLER_PATH
 
 app = Flask(__name__)
@@ -33,6 +36,11 @@ class Invoice(db.Model):
     stu_id = db.Column(db.String(50))
     bank_card = db.Column(db.String(50))
     folder_path = db.Column(db.String(200))
+    # 发票号 + 发票代码唯一（识别不出号码/代码的发票不参与），兜底并发上传同一张发票
+    __table_args__ = (
+        db.Index('uq_invoice_num_code', 'inv_num', 'inv_code', unique=True,
+                 sqlite_where=db.text("inv_num != '未知号码' AND inv_code != ''")),
+    )
 
 class InvoiceItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -48,8 +56,144 @@ class InvoiceItem(db.Model):
     tax = db.Column(db.String(50))
     invoice = db.relationship('Invoice', backref=db.backref('items', cascade='all, delete-orphan'))
 
-with app.app_context():
-    db.create_all()
+class PayerSummary(db.Model):
+    """按垫付人（姓名 + 学号）汇总的发票张数与金额"""
+    id = db.Column(db.Integer, primary_key=True)
+    payer = db.Column(db.String(50), nullable=False, default='')
+    stu_id = db.Column(db.String(50), nullable=False, default='')
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    total_cents = db.Column(db.BigInteger, nullable=False, default=0)  # 以分为单位，避免浮点累计误差
+    __table_args__ = (db.UniqueConstraint('payer', 'stu_id'),)
+
+class SellerSummary(db.Model):
+    """按供应商汇总的发票张数与金额"""
+    id = db.Column(db.Integer, primary_key=True)
+    seller = db.Column(db.String(100), nullable=False, default='', unique=True)
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    total_cents = db.Column(db.BigInteger, nullable=False, default=0)  # 以分为单位，避免浮点累计误差
+
+class MonthSummary(db.Model):
+    """按开票月份（YYYY-MM）汇总的发票张数与金额"""
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False, default='', unique=True)
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    total_cents = db.Column(db.BigInteger, nullable=False, default=0)  # 以分为单位，避免浮点累计误差
+
+class ImportJob(db.Model):
+    """批量导入任务，source 为导入目录或清单 CSV 的绝对路径"""
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(500), index=True)
+    status = db.Column(db.String(20), default='running')
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+
+class ImportRecord(db.Model):
+    """批量导入的逐文件检查点：created / duplicate / rejected 的文件在续传时跳过，failed（临时错误）的会重试"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('import_job.id', ondelete='CASCADE'), index=True)
+    file_path = db.Column(db.String(500))
+    status = db.Column(db.String(20))
+    message = db.Column(db.String(500))
+    invoice_id = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('job_id', 'file_path'),)
+
+class UploadSession(db.Model):
+    """分块上传会话：数据暂存于 storage/.uploads/<id>.part，finalize 后立即入库"""
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20))  # invoice：发票原件；extra：支付/订单等附件
+    filename = db.Column(db.String(200))
+    size = db.Column(db.BigInteger)
+    sha256 = db.Column(db.String(64))
+    inv_id = db.Column(db.Integer)
+    payer = db.Column(db.String(50))
+    stu_id = db.Column(db.String(50))
+    bank_card = db.Column(db.String(50))
+    fingerprint = db.Column(db.String(200), index=True)
+    status = db.Column(db.String(20), default='open')
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+# 格式化日期为 YYYY-MM-DD
+def fmt_date(s):
+    if not s: return ''
+    s = str(s).strip()
+    patterns = ['%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y年%m月%d日', '%Y%m%d', '%Y-%m-%d %H:%M:%S']
+    for p in patterns:
+        try:
+            dt = datetime.strptime(s, p)
+            return dt.strftime('%Y-%m-%d')
+        except: continue
+    m = re.search(r'(20\d{2}[-/.年]?\d{1,2}[-/.月]?\d{1,2})', s)
+    if m:
+        candidate = m.group(1).replace('年', '-').replace('月', '-').replace('日', '').replace('/', '-').replace('.', '-')
+        parts = candidate.split('-')
+        if len(parts) >= 3: return f"{parts[0]}-{parts[1].zfill(2)}-{parts[2].zfill(2)}"
+    return s
+
+def invoice_amount_cents(inv):
+    """发票价税合计（分），无法解析时按 0 计"""
+    try:
+        amount = Decimal(str(inv.total).replace(',', '')) if inv.total else Decimal(0)
+        return int((amount * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        return 0
+
+def invoice_month(inv):
+    d = fmt_date(inv.date)
+    return d[:7] if re.match(r'^\d{4}-\d{2}', d) else '未知'
+
+def _summary_keys(inv):
+    """每张汇总表对应的 (模型, 主键字段) 列表"""
+    return [
+        (PayerSummary, {'payer': inv.payer or '', 'stu_id': inv.stu_id or ''}),
+        (SellerSummary, {'seller': inv.seller or ''}),
+        (MonthSummary, {'month': invoice_month(inv)}),
+    ]
+
+def apply_invoice_to_summaries(inv, sign=1):
+    """在当前事务内增量更新汇总表：sign=1 表示新增发票，sign=-1 表示删除发票。
+    调用方负责 commit，使汇总与发票记录同时生效或同时回滚。"""
+    cents = invoice_amount_cents(inv) * sign
+    for model, keys in _summary_keys(inv):
+        # 使用 SQL 端自增，避免并发请求之间互相覆盖
+        updated = model.query.filter_by(**keys).update({
+            model.invoice_count: model.invoice_count + sign,
+            model.total_cents: model.total_cents + cents,
+        }, synchronize_session=False)
+        if not updated and sign > 0:
+            db.session.add(model(invoice_count=1, total_cents=cents, **keys))
+        elif sign < 0:
+            model.query.filter(model.invoice_count <= 0).delete(synchronize_session=False)
+    db.session.flush()
+
+def rebuild_summaries():
+    """根据 Invoice 全表重建汇总表（用于旧库首次升级或数据修复）"""
+    for model in (PayerSummary, SellerSummary, MonthSummary):
+        model.query.delete()
+    db.session.flush()
+    for inv in Invoice.query.all():
+        apply_invoice_to_summaries(inv)
+    db.session.commit()
+
+def init_db():
+    """建表并回填汇总表；启动时显式调用一次（python app.py 或 flask init-db），不在导入时执行"""
+    with app.app_context():
+        db.create_all()
+        # create_all 不会给已存在的 invoice 表补建索引，这里单独补建；已有重复数据时跳过
+        for index in Invoice.__table__.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except IntegrityError:
+                print(f"发票表存在重复的发票号/代码，未能创建唯一索引 {index.name}")
+        # 旧数据库没有汇总表数据时，按现有发票回填一次
+        if Invoice.query.first() and not (PayerSummary.query.first() or SellerSummary.query.first() or MonthSummary.query.first()):
+            rebuild_summaries()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """创建 / 升级数据库表结构（部署或升级后执行一次）。"""
+    init_db()
+    click.echo('数据库已初始化')
 
 
 def save_items_from_words(inv, words):
@@ -177,6 +321,140 @@ def get_invoice_detail(inv_id):
         'files_list': files_list
     })
 
+class IngestError(Exception):
+    """单个发票文件入库失败；level 用于前端 flash 提示级别。
+    status 用于批量导入报告：failed 为临时错误（续传时重试），rejected 为重试也不会成功的文件，duplicate 为重复发票"""
+    def __init__(self, message, status='failed', level='danger'):
+        super().__init__(message)
+        self.status = status
+        self.level = level
+
+# 百度 OCR 的临时性错误码（服务不可用、限流/配额、token 失效、内部错误），其余错误码视为文件本身无法识别
+BAIDU_RETRYABLE_ERRORS = {1, 2, 4, 17, 18, 19, 110, 111, 282000}
+
+def make_ocr_client(aid=None, ak=None, sk=None):
+    # 百度 SDK 会连带加载 requests 及 SSL，仅在真正识别时导入
+    from aip import AipOcr
+    return AipOcr(aid or BAIDU_CONFIG['APP_ID'], ak or BAIDU_CONFIG['API_KEY'], sk or BAIDU_CONFIG['SECRET_KEY'])
+
+def extract_val(dct, key):
+    v = dct.get(key)
+    if isinstance(v, list): v = v[0] if v else None
+    return v.get('word') if isinstance(v, dict) else v
+
+def recognize_invoice(client, path, filename):
+    """PDF 转图片并调用百度 OCR，返回 words_result；不访问数据库，可在线程池中并行调用"""
+    if filename.lower().endswith('.pdf'):
+        from pdf2image import convert_from_path
+        images = convert_from_path(path, dpi=200, poppler_path=POPPLER_PATH)
+        buf = io.BytesIO()
+        images[0].save(buf, format='JPEG', quality=85)
+        image_data = buf.getvalue()
+    else:
+        with open(path, 'rb') as f:
+            image_data = f.read()
+
+    res = client.vatInvoice(image_data)
+    if 'error_code' in res:
+        status = 'failed' if res.get('error_code') in BAIDU_RETRYABLE_ERRORS else 'rejected'
+        raise IngestError(f"文件 {filename} 识别错误: {res.get('error_msg')}", status=status)
+
+    data = res.get('words_result', {})
+    if not any([data.get('InvoiceCode'), data.get('InvoiceNum'), data.get('CommodityName')]):
+        raise IngestError(f'文件 {filename} 识别失败：非标准发票', status='rejected', level='warning')
+    return data
+
+# 没有对应 Invoice 记录的发票目录超过该时长（秒）视为遗留目录
+ORPHAN_FOLDER_AGE = 10 * 60
+
+def save_invoice(data, src_path, filename, payer=None, stu_id=None, bank_card=None, keep_source=False):
+    """查重、建目录、写入 Invoice/明细/汇总表并提交。
+    keep_source=True 时复制源文件（批量导入），否则移动（网页上传的临时文件）"""
+    inv_num = extract_val(data, 'InvoiceNum')
+    inv_code = extract_val(data, 'InvoiceCode')
+    if inv_num: inv_num = inv_num.strip()
+    if inv_code: inv_code = inv_code.strip()
+
+    # 查重逻辑
+    if inv_num and inv_code:
+        existing = Invoice.query.filter_by(inv_num=inv_num, inv_code=inv_code).first()
+        if existing:
+            raise IngestError(f'⚠️ 重复上传：发票号 {inv_num} 已存在，已自动跳过。', status='duplicate', level='warning')
+
+    inv_num = inv_num or '未知号码'
+    g_name = data.get('CommodityName', [{'word': '未知商品'}])[0]['word']
+    safe_g_name = clean_path_name(g_name)
+    payer = payer or '匿名'
+
+    # 截取商品名前16位
+    short_g_name = safe_g_name[:16]
+
+    # 仅截取发票号最后 4 位
+    short_inv_num = inv_num[-4:] if len(inv_num) >= 4 else inv_num
+
+    # 组合名称：姓名_前16位商品名_发票后4位
+    base_folder_name = f"{payer}_{short_g_name}_{short_inv_num}"
+    inv_dir = os.path.join('storage', base_folder_name)
+
+    # 以原子 mkdir 占位：并发处理同一张发票时只有一个请求能拿到目录
+    try:
+        os.makedirs(inv_dir)
+    except FileExistsError:
+        # 有对应记录，说明该发票（或同名发票）已处理过
+        if Invoice.query.filter_by(folder_path=inv_dir).first():
+            raise IngestError(f'文件夹冲突：发票 {short_inv_num} 已存在，已自动跳过。', status='duplicate', level='warning')
+        # 没有记录且长时间未变动：进程被强杀等情况遗留的目录，清理后重新入库
+        if time.time() - os.path.getmtime(inv_dir) > ORPHAN_FOLDER_AGE:
+            shutil.rmtree(inv_dir)
+            os.makedirs(inv_dir)
+        else:
+            raise IngestError(f'文件夹冲突：发票 {short_inv_num} 正在由其它上传处理，请稍后重试。', level='warning')
+    final_folder_name = os.path.basename(inv_dir)
+
+    try:
+        # 数据库保存
+        new_inv = Invoice(
+            inv_num=inv_num,
+            inv_code=inv_code or '',
+            date=extract_val(data, 'InvoiceDate') or '',
+            seller=extract_val(data, 'SellerName') or '',
+            total=str(data.get('AmountInFiguers') or data.get('TotalAmount') or '0'),
+            good_name=g_name,
+            spec=extract_val(data, 'CommodityType') or '-',
+            unit=extract_val(data, 'CommodityUnit') or '-',
+            quantity=extract_val(data, 'CommodityNum') or '-',
+            price=extract_val(data, 'CommodityPrice') or '-',
+            payer=payer,
+            stu_id=stu_id,
+            bank_card=bank_card,
+            folder_path=inv_dir
+        )
+        db.session.add(new_inv)
+        db.session.flush()
+
+        # 文件移动与TXT生成
+        ext = os.path.splitext(filename)[1]
+        if keep_source:
+            shutil.copyfile(src_path, os.path.join(inv_dir, f"发票{ext}"))
+        else:
+            os.rename(src_path, os.path.join(inv_dir, f"发票{ext}"))
+
+        with open(os.path.join(inv_dir, f"{final_folder_name}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"姓名：{new_inv.payer}\n学号：{new_inv.stu_id}\n银行卡号：{new_inv.bank_card}")
+
+        # 汇总表与发票记录在同一事务中提交
+        apply_invoice_to_summaries(new_inv)
+        save_items_from_words(new_inv, data)
+        db.session.commit()
+    except BaseException as e:
+        # 入库失败（含 Ctrl-C 中断）时回滚并删除本次创建的目录，避免续传时被误判为重复
+        db.session.rollback()
+        shutil.rmtree(inv_dir, ignore_errors=True)
+        if isinstance(e, IntegrityError):
+            raise IngestError(f'⚠️ 重复上传：发票号 {inv_num} 已存在，已自动跳过。', status='duplicate', level='warning') from e
+        raise
+    return new_inv
+
 @app.route('/upload', methods=['POST'])
 def upload():
     # 获取文件列表支持批量上传
@@ -185,10 +463,7 @@ def upload():
         flash('请选择发票文件进行上传', 'warning')
         return redirect(url_for('index'))
     
-    aid = request.form.get('app_id') or BAIDU_CONFIG['APP_ID']
-    ak = request.form.get('api_key') or BAIDU_CONFIG['API_KEY']
-    sk = request.form.get('secret_key') or BAIDU_CONFIG['SECRET_KEY']
-    client = AipOcr(aid, ak, sk)
+    client = make_ocr_client(request.form.get('app_id'), request.form.get('api_key'), request.form.get('secret_key'))
 
     success_count = 0
     
@@ -202,105 +477,15 @@ def upload():
         file.save(temp_path)
         
         try:
-            # PDF 转图片
-            if file.filename.lower().endswith('.pdf'):
-                images = convert_from_path(temp_path, dpi=200, poppler_path=POPPLER_PATH)
-                buf = io.BytesIO()
-                images[0].save(buf, format='JPEG', quality=85)
-                image_data = buf.getvalue()
-            else:
-                with open(temp_path, 'rb') as f:
-                    image_data = f.read()
-
-            # 调用百度 OCR
-            res = client.vatInvoice(image_data)
-            if 'error_code' in res:
-                flash(f"文件 {file.filename} 识别错误: {res.get('error_msg')}", 'danger')
-                continue
-
-            data = res.get('words_result', {})
-            if not any([data.get('InvoiceCode'), data.get('InvoiceNum'), data.get('CommodityName')]):
-                flash(f'文件 {file.filename} 识别失败：非标准发票', 'warning')
-                continue
-
-           # 提取信息
-            def extract_val(dct, key):
-                v = dct.get(key)
-                if isinstance(v, list): v = v[0] if v else None
-                return v.get('word') if isinstance(v, dict) else v
-
-            inv_num = extract_val(data, 'InvoiceNum')
-            inv_code = extract_val(data, 'InvoiceCode')
-            if inv_num: inv_num = inv_num.strip()
-            if inv_code: inv_code = inv_code.strip()
-
-            # 查重逻辑
-            if inv_num and inv_code:
-                existing = Invoice.query.filter_by(inv_num=inv_num, inv_code=inv_code).first()
-                if existing:
-                    # 这里的提醒会显示在前端
-                    flash(f'⚠️ 重复上传：发票号 {inv_num} 已存在，已自动跳过。', 'warning')
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-                    continue
-
-
-            inv_num = inv_num or '未知号码'
-            g_name = data.get('CommodityName', [{'word': '未知商品'}])[0]['word']
-            safe_g_name = clean_path_name(g_name)
-            payer = request.form.get('payer') or '匿名'
-
-            # 截取商品名前16位
-            short_g_name = safe_g_name[:16]
-            
-            # 仅截取发票号最后 4 位
-            short_inv_num = inv_num[-4:] if len(inv_num) >= 4 else inv_num
-            
-            # 组合名称：姓名_前16位商品名_发票后4位
-            base_folder_name = f"{payer}_{short_g_name}_{short_inv_num}"
-            inv_dir = os.path.join('storage', base_folder_name)
-            
-            # 如果文件夹已存在，说明该发票（或同名发票）已处理过
-            if os.path.exists(inv_dir):
-                flash(f'文件夹冲突：发票 {short_inv_num} 已存在，已自动跳过。', 'warning')
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                continue
-            
-            os.makedirs(inv_dir, exist_ok=True)
-            final_folder_name = os.path.basename(inv_dir)
-
-            # 数据库保存
-            new_inv = Invoice(
-                inv_num=inv_num,
-                inv_code=extract_val(data, 'InvoiceCode') or '',
-                date=extract_val(data, 'InvoiceDate') or '',
-                seller=extract_val(data, 'SellerName') or '',
-                total=str(data.get('AmountInFiguers') or data.get('TotalAmount') or '0'),
-                good_name=g_name,
-                spec=extract_val(data, 'CommodityType') or '-',
-                unit=extract_val(data, 'CommodityUnit') or '-',
-                quantity=extract_val(data, 'CommodityNum') or '-',
-                price=extract_val(data, 'CommodityPrice') or '-',
-                payer=payer,
-                stu_id=request.form.get('stu_id'),
-                bank_card=request.form.get('bank_card'),
-                folder_path=inv_dir
-            )
-            db.session.add(new_inv)
-            db.session.flush()
-
-            # 文件移动与TXT生成
-            ext = os.path.splitext(file.filename)[1]
-            os.rename(temp_path, os.path.join(inv_dir, f"发票{ext}"))
-
-            with open(os.path.join(inv_dir, f"{final_folder_name}.txt"), "w", encoding="utf-8") as f:
-                f.write(f"姓名：{new_inv.payer}\n学号：{new_inv.stu_id}\n银行卡号：{new_inv.bank_card}")
-
-            save_items_from_words(new_inv, data)
-            db.session.commit()
+            data = recognize_invoice(client, temp_path, file.filename)
+            save_invoice(data, temp_path, file.filename,
+                         payer=request.form.get('payer'),
+                         stu_id=request.form.get('stu_id'),
+                         bank_card=request.form.get('bank_card'))
             success_count += 1
-
+        except IngestError as e:
+            db.session.rollback()
+            flash(str(e), e.level)
         except Exception as e:
             db.session.rollback()
             flash(f'处理文件 {file.filename} 出错: {str(e)}', 'danger')
@@ -387,7 +572,8 @@ def delete_invoice(inv_id):
                 import shutil
                 shutil.rmtree(inv.folder_path)
             
-            # 数据库删除
+            # 数据库删除（同时扣减汇总表）
+            apply_invoice_to_summaries(inv, sign=-1)
             db.session.delete(inv)
             db.session.commit()
             result_ok = True
@@ -455,6 +641,49 @@ def preview_attachment(inv_id):
     return send_file(target, mimetype=mime or 'application/octet-stream')
 
 
+SUMMARY_VIEWS = {
+    'payers': (PayerSummary, ('payer', 'stu_id')),
+    'sellers': (SellerSummary, ('seller',)),
+    'months': (MonthSummary, ('month',)),
+}
+
+@app.route('/summary')
+def summary_overview():
+    """AJAX 接口：全部发票的总张数与总金额（读取汇总表，不扫描明细）"""
+    row = db.session.query(
+        db.func.coalesce(db.func.sum(MonthSummary.invoice_count), 0),
+        db.func.coalesce(db.func.sum(MonthSummary.total_cents), 0),
+    ).one()
+    return jsonify({'ok': True, 'invoice_count': int(row[0]), 'total_amount': int(row[1]) / 100})
+
+@app.route('/summary/<dimension>')
+def summary_detail(dimension):
+    """AJAX 接口：按垫付人 / 供应商 / 月份返回汇总数据
+    可按维度字段精确过滤，如 ?payer=张三、?month=2025-01"""
+    view = SUMMARY_VIEWS.get(dimension)
+    if not view:
+        return jsonify({'ok': False, 'error': f'未知的汇总维度: {dimension}'}), 404
+    model, key_fields = view
+
+    query = model.query
+    for field in key_fields:
+        value = request.args.get(field)
+        if value is not None:
+            query = query.filter(getattr(model, field) == value)
+    if dimension == 'months':
+        query = query.order_by(model.month.desc())
+    else:
+        query = query.order_by(model.total_cents.desc())
+
+    rows = []
+    for r in query.all():
+        item = {field: getattr(r, field) for field in key_fields}
+        item['invoice_count'] = r.invoice_count
+        item['total_amount'] = r.total_cents / 100
+        rows.append(item)
+    return jsonify({'ok': True, 'dimension': dimension, 'rows': rows})
+
+
 @app.route('/baidu_tutorial')
 def baidu_tutorial():
     return render_template('baidu_tutorial.html')
@@ -468,24 +697,6 @@ def download_all():
     
     data = []
 
-    # 格式化日期为 YYYY-MM-DD
-    def fmt_date(s):
-        if not s: return ''
-        s = str(s).strip()
-        from datetime import datetime
-        patterns = ['%Y-%m-%d', '%Y/%m/%d', '%Y.%m.%d', '%Y年%m月%d日', '%Y%m%d', '%Y-%m-%d %H:%M:%S']
-        for p in patterns:
-            try:
-                dt = datetime.strptime(s, p)
-                return dt.strftime('%Y-%m-%d')
-            except: continue
-        m = re.search(r'(20\d{2}[-/.年]?\d{1,2}[-/.月]?\d{1,2})', s)
-        if m:
-            candidate = m.group(1).replace('年', '-').replace('月', '-').replace('日', '').replace('/', '-').replace('.', '-')
-            parts = candidate.split('-')
-            if len(parts) >= 3: return f"{parts[0]}-{parts[1].zfill(2)}-{parts[2].zfill(2)}"
-        return s
-
     for inv in invoices:
         if inv.items:
             # --- 情况 A：存在明细表 ---
@@ -552,6 +763,7 @@ def download_all():
             })
 
     # --- 后续 Excel 生成和 ZIP 打包逻辑 ---
+    import pandas as pd
     columns = ["发票垫付人", "学号", "南京大学工行卡卡号", "报销商品名称", "规格型号", "单位", "供应商", "发票号", "发票代码", "数量", "总金额", "单价", "开票日期"]
     df = pd.DataFrame(data, columns=columns)
     excel_p = "汇总.xlsx"
@@ -578,6 +790,7 @@ def download_all():
 
         if os.path.exists('storage'):
             for folder in os.listdir('storage'):
+                if folder.startswith('.'): continue
                 fpath = os.path.join('storage', folder)
                 if os.path.isdir(fpath):
                     for fname in os.listdir(fpath):
@@ -675,6 +888,18 @@ def upload_extra(inv_id):
             error_msgs.append(f'{file.filename}: {str(e)}')
     
     # 重新读取该发票的文件列表
+    files_list, has_pay, has_order = attachment_state(inv)
+    return jsonify({
+        'ok': True,
+        'success_count': success_count,
+        'errors': error_msgs,
+        'files_list': files_list,
+        'has_pay': has_pay,
+        'has_order': has_order
+    })
+
+def attachment_state(inv):
+    """返回 (files_list, has_pay, has_order)，供附件相关接口刷新前端"""
     files_list = []
     has_pay = False
     has_order = False
@@ -684,26 +909,313 @@ def upload_extra(inv_id):
             if f == '.trash': continue
             if '支付' in f: has_pay = True
             if '订单' in f: has_order = True
-            
+
             protected = False
             if f.startswith('发票') or f == f"{base_folder}.txt":
                 protected = True
             files_list.append({'name': f, 'protected': protected})
-    
-    return jsonify({
-        'ok': True,
-        'success_count': success_count,
-        'errors': error_msgs,
-        'files_list': files_list,
-        'has_pay': has_pay,
-        'has_order': has_order
-    })
+    return files_list, has_pay, has_order
+
+def save_extra_file(inv, src_path, filename):
+    """把附件移动到发票目录，同名时加时间戳，返回最终文件名"""
+    target_path = os.path.join(inv.folder_path, filename)
+    if os.path.exists(target_path):
+        import time
+        name, ext = os.path.splitext(filename)
+        filename = f"{name}_{int(time.time())}{ext}"
+        target_path = os.path.join(inv.folder_path, filename)
+    shutil.move(src_path, target_path)
+    return filename
+
+
+# ---------- 分块 / 断点续传上传 ----------
+# 协议：POST /upload_session 创建会话 -> PUT /upload_session/<id>?offset=N 逐块上传
+# -> POST /upload_session/<id>/finalize 校验并立即处理该文件。
+# 断线后 GET /upload_session/<id> 取得服务端已接收字节数，从该偏移继续上传。
+UPLOAD_PART_DIR = os.path.join('storage', '.uploads')
+UPLOAD_READ_SIZE = 64 * 1024
+UPLOAD_SESSION_TTL = timedelta(days=1)
+# 锁文件超过该时长（秒）仍未释放，视为持锁请求已异常退出
+UPLOAD_LOCK_STALE = 15 * 60
+
+def _part_path(upload_id):
+    return os.path.join(UPLOAD_PART_DIR, f"{upload_id}.part")
+
+def _lock_path(upload_id):
+    return os.path.join(UPLOAD_PART_DIR, f"{upload_id}.lock")
+
+def _acquire_upload_lock(upload_id):
+    """以 O_EXCL 创建锁文件实现跨进程互斥（Windows / Linux 通用），
+    防止同一会话的重复请求（如代理超时后客户端重试）同时追加写入"""
+    path = _lock_path(upload_id)
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) <= UPLOAD_LOCK_STALE:
+                    return False
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return False
+
+def _release_upload_lock(upload_id):
+    try:
+        os.remove(_lock_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+def _received_bytes(upload_id):
+    part = _part_path(upload_id)
+    return os.path.getsize(part) if os.path.exists(part) else 0
+
+def _part_missing(sess):
+    """未结束的会话丢失了 .part 文件（如被一键清空）时标记为失败，客户端需重新上传"""
+    if sess.status == 'open' and not os.path.exists(_part_path(sess.id)):
+        sess.status = 'failed'
+        db.session.commit()
+    return sess.status == 'failed'
+
+def _session_json(sess):
+    return {'ok': True, 'upload_id': sess.id, 'status': sess.status,
+            'size': sess.size, 'received': _received_bytes(sess.id)}
+
+def _purge_stale_upload_sessions():
+    cutoff = datetime.now() - UPLOAD_SESSION_TTL
+    for sess in UploadSession.query.filter(UploadSession.created_at < cutoff).all():
+        for path in (_part_path(sess.id), _lock_path(sess.id)):
+            if os.path.exists(path):
+                os.remove(path)
+        db.session.delete(sess)
+    db.session.commit()
+
+@app.route('/upload_session', methods=['POST'])
+def upload_session_init():
+    """创建上传会话；若带相同 fingerprint 的会话仍未完成，则直接返回它以便续传"""
+    args = request.get_json(silent=True) or request.form
+    filename = os.path.basename((args.get('filename') or '').strip())
+    kind = args.get('kind') or 'invoice'
+    try:
+        size = int(args.get('size'))
+    except (TypeError, ValueError):
+        size = -1
+    if not filename or size < 0 or kind not in ('invoice', 'extra'):
+        return jsonify({'ok': False, 'error': '缺少文件名、大小或类型不正确'}), 400
+
+    inv_id = args.get('inv_id')
+    if kind == 'extra':
+        inv = Invoice.query.get(inv_id) if inv_id else None
+        if not inv:
+            return jsonify({'ok': False, 'error': '发票不存在'}), 404
+
+    _purge_stale_upload_sessions()
+
+    fingerprint = args.get('fingerprint')
+    if fingerprint:
+        sess = UploadSession.query.filter_by(fingerprint=fingerprint, status='open').first()
+        sha256 = (args.get('sha256') or '').lower() or None
+        if (sess and sess.size == size and sess.filename == filename and sess.sha256 == sha256
+                and not _part_missing(sess)):
+            # 续传时以本次提交的垫付人信息为准
+            sess.payer = args.get('payer')
+            sess.stu_id = args.get('stu_id')
+            sess.bank_card = args.get('bank_card')
+            db.session.commit()
+            return jsonify(_session_json(sess))
+
+    os.makedirs(UPLOAD_PART_DIR, exist_ok=True)
+    sess = UploadSession(
+        id=uuid.uuid4().hex,
+        kind=kind,
+        filename=filename,
+        size=size,
+        sha256=(args.get('sha256') or '').lower() or None,
+        inv_id=int(inv_id) if kind == 'extra' else None,
+        payer=args.get('payer'),
+        stu_id=args.get('stu_id'),
+        bank_card=args.get('bank_card'),
+        fingerprint=fingerprint,
+    )
+    db.session.add(sess)
+    db.session.commit()
+    open(_part_path(sess.id), 'wb').close()
+    return jsonify(_session_json(sess))
+
+@app.route('/upload_session/<upload_id>', methods=['GET'])
+def upload_session_status(upload_id):
+    sess = UploadSession.query.get(upload_id)
+    if not sess:
+        return jsonify({'ok': False, 'error': '上传会话不存在'}), 404
+    if _part_missing(sess):
+        return jsonify({'ok': False, 'error': '上传数据已丢失，请重新上传'}), 410
+    return jsonify(_session_json(sess))
+
+@app.route('/upload_session/<upload_id>', methods=['PUT'])
+def upload_session_chunk(upload_id):
+    """写入一个分块：请求体直接流式追加到 .part 文件，不经过表单解析。
+    可选请求头 X-Chunk-Sha256 校验本块内容，不一致或传输中断时回退到块起点。"""
+    sess = UploadSession.query.get(upload_id)
+    if not sess or sess.status != 'open':
+        return jsonify({'ok': False, 'error': '上传会话不存在或已结束'}), 404
+    if _part_missing(sess):
+        return jsonify({'ok': False, 'error': '上传数据已丢失，请重新上传'}), 410
+
+    # 偏移量须在持锁后检查，否则两个同偏移的请求会先后通过检查并交错追加
+    if not _acquire_upload_lock(upload_id):
+        return jsonify({'ok': False, 'error': 'busy', 'received': _received_bytes(upload_id)}), 409
+    try:
+        return _write_chunk(sess, upload_id)
+    finally:
+        _release_upload_lock(upload_id)
+
+def _session_closed_while_waiting(sess):
+    """持锁后重新读取会话状态：等待期间可能已被另一个请求 finalize 或清空"""
+    try:
+        db.session.refresh(sess)
+    except InvalidRequestError:
+        # 会话记录已被一键清空删除
+        return True
+    return sess.status != 'open' or not os.path.exists(_part_path(sess.id))
+
+def _write_chunk(sess, upload_id):
+    if _session_closed_while_waiting(sess):
+        return jsonify({'ok': False, 'error': '上传会话不存在或已结束'}), 410
+    received = _received_bytes(upload_id)
+    offset = request.args.get('offset', type=int)
+    if offset != received:
+        return jsonify({'ok': False, 'error': 'offset_mismatch', 'received': received}), 409
+
+    expected = (request.headers.get('X-Chunk-Sha256') or '').lower()
+    h = hashlib.sha256()
+    written = 0
+    part = _part_path(upload_id)
+    try:
+        with open(part, 'ab') as f:
+            while True:
+                block = request.stream.read(UPLOAD_READ_SIZE)
+                if not block:
+                    break
+                if received + written + len(block) > sess.size:
+                    raise ValueError('数据超出声明的文件大小')
+                f.write(block)
+                h.update(block)
+                written += len(block)
+        if expected and h.hexdigest() != expected:
+            raise ValueError('分块校验失败')
+    except ValueError as e:
+        with open(part, 'ab') as f:
+            f.truncate(received)
+        return jsonify({'ok': False, 'error': str(e), 'received': received}), 400
+    except ClientDisconnected:
+        # 连接中断：带分块校验时已写入的部分无法校验，回退到块起点；否则保留已落盘的前缀
+        if expected:
+            with open(part, 'ab') as f:
+                f.truncate(received)
+        return jsonify({'ok': False, 'error': 'client_disconnected', 'received': _received_bytes(upload_id)}), 400
+    except OSError as e:
+        # 磁盘写满等服务端错误：回退本块并如实报错，不能当作成功
+        try:
+            with open(part, 'ab') as f:
+                f.truncate(received)
+        except OSError:
+            pass
+        return jsonify({'ok': False, 'error': f'写入失败: {str(e)}', 'received': received}), 500
+
+    return jsonify({'ok': True, 'received': _received_bytes(upload_id)})
+
+@app.route('/upload_session/<upload_id>/finalize', methods=['POST'])
+def upload_session_finalize(upload_id):
+    """校验完整性后立即处理该文件：发票走识别入库流程，附件移动到发票目录"""
+    sess = UploadSession.query.get(upload_id)
+    if not sess or sess.status != 'open':
+        return jsonify({'ok': False, 'error': '上传会话不存在或已结束'}), 404
+    if _part_missing(sess):
+        return jsonify({'ok': False, 'error': '上传数据已丢失，请重新上传'}), 410
+
+    if not _acquire_upload_lock(upload_id):
+        return jsonify({'ok': False, 'error': 'busy', 'retryable': True}), 409
+    try:
+        return _finalize_upload(sess, upload_id)
+    finally:
+        _release_upload_lock(upload_id)
+
+def _finalize_upload(sess, upload_id):
+    if _session_closed_while_waiting(sess):
+        return jsonify({'ok': False, 'error': '上传会话不存在或已结束'}), 410
+    part = _part_path(upload_id)
+    received = _received_bytes(upload_id)
+    if received != sess.size:
+        return jsonify({'ok': False, 'error': 'incomplete', 'received': received}), 409
+
+    if sess.sha256:
+        h = hashlib.sha256()
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_READ_SIZE), b''):
+                h.update(block)
+        if h.hexdigest() != sess.sha256:
+            os.remove(part)
+            sess.status = 'failed'
+            db.session.commit()
+            return jsonify({'ok': False, 'error': '文件校验失败，请重新上传'}), 400
+
+    args = request.get_json(silent=True) or request.form
+    result = {'ok': True, 'filename': sess.filename}
+    # 只有得到最终结果（成功、重复或重试也不会成功）时才删除数据并结束会话；
+    # 临时失败（OCR 限流、网络错误、目录被占用等）保留会话，客户端可再次 finalize 而无需重传
+    final = True
+    if sess.kind == 'extra':
+        inv = Invoice.query.get(sess.inv_id)
+        if not inv:
+            result = {'ok': False, 'error': '发票不存在'}
+        else:
+            try:
+                result['filename'] = save_extra_file(inv, part, sess.filename)
+                result['files_list'], result['has_pay'], result['has_order'] = attachment_state(inv)
+            except Exception as e:
+                final = False
+                result = {'ok': False, 'error': f'{sess.filename}: {str(e)}'}
+    else:
+        try:
+            client = make_ocr_client(args.get('app_id'), args.get('api_key'), args.get('secret_key'))
+            data = recognize_invoice(client, part, sess.filename)
+            # 复制而不是移动 .part，入库失败时上传的数据仍在，可再次 finalize
+            inv = save_invoice(data, part, sess.filename,
+                               payer=sess.payer, stu_id=sess.stu_id, bank_card=sess.bank_card,
+                               keep_source=True)
+            result.update({'status': 'created', 'invoice_id': inv.id})
+        except IngestError as e:
+            db.session.rollback()
+            final = e.status != 'failed'
+            result.update({'status': e.status, 'level': e.level, 'message': str(e)})
+        except Exception as e:
+            db.session.rollback()
+            final = False
+            result.update({'status': 'failed', 'level': 'danger',
+                           'message': f'处理文件 {sess.filename} 出错: {str(e)}'})
+
+    if final:
+        if os.path.exists(part):
+            os.remove(part)
+        sess.status = 'done'
+        db.session.commit()
+    else:
+        result['retryable'] = True
+    return jsonify(result)
 
 @app.route('/clear_all', methods=['POST'])
 def clear_all():
     try:
         db.session.query(InvoiceItem).delete()
         db.session.query(Invoice).delete()
+        for model in (PayerSummary, SellerSummary, MonthSummary):
+            db.session.query(model).delete()
+        # storage/.uploads 会被一并清空，未完成的上传会话随之作废
+        db.session.query(UploadSession).delete()
+        # 导入检查点指向的发票已被删除，续传会误跳过这些文件，一并清除
+        db.session.query(ImportRecord).delete()
+        db.session.query(ImportJob).delete()
         db.session.commit()
         
         if os.path.exists('storage'):
@@ -723,6 +1235,130 @@ def clear_all():
         flash(f'清空失败: {str(e)}', 'danger')
     return redirect(url_for('index'))
 
+INVOICE_EXTS = ('.pdf', '.jpg', '.jpeg', '.png')
+
+def _collect_import_entries(source, payer, stu_id, bank_card):
+    """返回 [(绝对路径, payer, stu_id, bank_card)]；source 可为目录或清单 CSV（列：file,payer,stu_id,bank_card）"""
+    entries = []
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for fname in sorted(files):
+                if fname.lower().endswith(INVOICE_EXTS):
+                    entries.append((os.path.abspath(os.path.join(root, fname)), payer, stu_id, bank_card))
+        return entries
+
+    base_dir = os.path.dirname(source)
+    with open(source, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            path = (row.get('file') or '').strip()
+            if not path:
+                continue
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            entries.append((
+                os.path.abspath(path),
+                (row.get('payer') or '').strip() or payer,
+                (row.get('stu_id') or '').strip() or stu_id,
+                (row.get('bank_card') or '').strip() or bank_card,
+            ))
+    return entries
+
+@app.cli.command('import-invoices')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--payer', default=None, help='默认垫付人（清单中未填写时使用）')
+@click.option('--stu-id', default=None, help='默认学号')
+@click.option('--bank-card', default=None, help='默认银行卡号')
+@click.option('-j', '--workers', default=4, show_default=True, help='并行识别的线程数')
+@click.option('--report', type=click.Path(), default=None, help='导入报告 CSV 路径，默认 import_report_<任务号>.csv')
+@click.option('--restart', is_flag=True, help='忽略未完成的同源任务，重新开始')
+def import_invoices(source, payer, stu_id, bank_card, workers, report, restart):
+    """批量导入发票目录或清单 CSV，中断后再次执行同一命令即可续传。"""
+    os.makedirs('storage', exist_ok=True)
+    init_db()
+    source = os.path.abspath(source)
+
+    job = None
+    if not restart:
+        job = ImportJob.query.filter_by(source=source, status='running').order_by(ImportJob.id.desc()).first()
+    if job:
+        click.echo(f'继续未完成的导入任务 #{job.id}')
+    else:
+        job = ImportJob(source=source)
+        db.session.add(job)
+        db.session.commit()
+        click.echo(f'新建导入任务 #{job.id}')
+
+    records = {r.file_path: r for r in ImportRecord.query.filter_by(job_id=job.id)}
+    entries = _collect_import_entries(source, payer, stu_id, bank_card)
+    pending = [e for e in entries
+               if e[0] not in records or records[e[0]].status == 'failed']
+    click.echo(f'共 {len(entries)} 个文件，已完成 {len(entries) - len(pending)} 个，待处理 {len(pending)} 个')
+
+    # AipOcr 内部缓存 access token，不在线程间共享
+    local = threading.local()
+    def ocr(path):
+        if not hasattr(local, 'client'):
+            local.client = make_ocr_client()
+        return recognize_invoice(local.client, path, os.path.basename(path))
+
+    def checkpoint(path, status, message='', invoice_id=None):
+        rec = records.get(path)
+        if rec is None:
+            rec = ImportRecord(job_id=job.id, file_path=path)
+            db.session.add(rec)
+            records[path] = rec
+        rec.status = status
+        rec.message = message[:500]
+        rec.invoice_id = invoice_id
+        db.session.commit()
+
+    # 识别在线程池中并行执行，数据库写入在主线程串行进行（SQLite 单写者）
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = {pool.submit(ocr, e[0]): e for e in pending}
+        for done, fut in enumerate(as_completed(futures), 1):
+            path, e_payer, e_stu_id, e_bank_card = futures[fut]
+            try:
+                data = fut.result()
+                inv = save_invoice(data, path, os.path.basename(path),
+                                   payer=e_payer, stu_id=e_stu_id, bank_card=e_bank_card,
+                                   keep_source=True)
+                checkpoint(path, 'created', invoice_id=inv.id)
+            except IngestError as e:
+                db.session.rollback()
+                checkpoint(path, e.status, str(e))
+            except Exception as e:
+                db.session.rollback()
+                checkpoint(path, 'failed', f'处理文件 {os.path.basename(path)} 出错: {str(e)}')
+            click.echo(f'[{done}/{len(pending)}] {records[path].status}: {path}')
+    except KeyboardInterrupt:
+        # 取消尚未开始的识别任务，避免退出前继续消耗 OCR 额度；已完成的文件均已记录检查点
+        pool.shutdown(wait=False, cancel_futures=True)
+        click.echo(f'已中断，进度已保存；再次执行相同命令即可从中断处继续（任务 #{job.id}）')
+        raise SystemExit(130)
+    pool.shutdown()
+
+    counts = {'created': 0, 'duplicate': 0, 'rejected': 0, 'failed': 0}
+    for rec in records.values():
+        counts[rec.status] = counts.get(rec.status, 0) + 1
+    if counts['failed'] == 0:
+        job.status = 'done'
+        job.finished_at = datetime.now()
+        db.session.commit()
+
+    report = report or f'import_report_{job.id}.csv'
+    with open(report, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'status', 'invoice_id', 'message'])
+        for rec in sorted(records.values(), key=lambda r: r.file_path):
+            writer.writerow([rec.file_path, rec.status, rec.invoice_id or '', rec.message or ''])
+
+    click.echo(f"新增 {counts['created']}，重复 {counts['duplicate']}，无法识别 {counts['rejected']}，失败 {counts['failed']}；报告已写入 {report}")
+    if counts['failed']:
+        click.echo(f'存在失败文件，再次执行相同命令将仅重试失败项（任务 #{job.id}）')
+
 if __name__ == '__main__':
     os.makedirs('storage', exist_ok=True)
+    init_db()
     app.run(debug=True)
\ No newline at end of file